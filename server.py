@@ -2,7 +2,7 @@ import warnings
 warnings.filterwarnings("ignore", message="This is a development server. Do not use it in a production deployment.")
 import json
 # Import Flask and related modules for web server and session management
-from flask import Flask, render_template, request, flash, session, redirect, url_for, abort, jsonify
+from flask import Flask, render_template, request, flash, session, redirect, url_for, abort, jsonify, g
 # Import Spotipy for Spotify API interaction
 import spotipy
 from spotipy.oauth2 import SpotifyOAuth
@@ -12,10 +12,20 @@ from urllib.parse import urlparse, urlunparse
 import secrets as pysecrets
 import random
 import os
-from threading import Lock
+import bisect
+import heapq
+from itertools import islice
+from collections import OrderedDict
+from threading import Lock, Thread, Event
 import socket
 from datetime import datetime
 import glob
+# For opt-in request profiling
+import cProfile
+import pstats
+import io
+import re
+import time
 
 # Load secrets (Spotify credentials and Flask secret key) from a JSON file
 with open("secrets.json") as f:
@@ -50,19 +60,109 @@ HOST_USER_ID = None
 added_songs_db = {}
 # In-memory dictionary to store all players' top tracks: {user_id: [track_url, ...]}
 all_top_tracks = {}
+# Running guess statistics, updated on every graded guess:
+# {track_url: {'correct': n, 'total': n}}, {display_name: {'correct': n, 'total': n}}
+# and {guesser: {adder: {'correct': n, 'total': n}}} (who fools whom)
+track_guess_stats = {}
+player_guess_stats = {}
+guess_confusion = {}
+guess_stats_lock = Lock()
 # Map of user_id -> cache_path for per-user Spotipy caches (set at /callback)
 USER_CACHE_MAP = {}
 # Map of user_id -> display_name for building selectable user lists
 USER_DISPLAY_NAMES = {}
 # File paths and locks for thread safety
 LEADERBOARD_FILE = 'leaderboard.json'
+LEADERBOARD_HISTORY_FILE = 'leaderboard_history.json'
 SONG_QUEUE_FILE = 'song_queue.json'
+TOP_TRACKS_CACHE_FILE = 'top_tracks_cache.json'
 leaderboard_lock = Lock()
+leaderboard_history_lock = Lock()
+# Serialises ending a round (numbering, snapshot, append and save)
+leaderboard_round_lock = Lock()
+# Score changes are written to LEADERBOARD_FILE at most once per this many seconds
+LEADERBOARD_SAVE_INTERVAL = 1.0
 song_queue_lock = Lock()
+# Roster version: bumped whenever the set of selectable players may have changed
+# (logins, song submissions, added songs) so cached rosters and page fragments
+# know when to rebuild.
+ROSTER_VERSION = 0
+roster_cache = {'version': None, 'users': []}
+roster_lock = Lock()
+# Room-wide game page fragments, keyed by (current track ID, roster version)
+game_fragment_cache = {}
+game_fragment_lock = Lock()
 # Server-side session version. Incremented on server start to invalidate client sessions.
 SERVER_SESSION_VERSION = None
 # How many incorrect guesses a player may make per song before being blocked
 GUESS_LIMIT = 1
+# How many top tracks each player contributes, and how long (seconds) a cached
+# copy is served before it is refreshed in the background (default one week)
+TOP_TRACKS_LIMIT = 5
+TOP_TRACKS_CACHE_TTL = int(secrets.get('TOP_TRACKS_CACHE_TTL', 7 * 24 * 3600))
+# Opt-in request profiling (optional keys in secrets.json). When enabled, a
+# request is profiled if a logged-in session sends PROFILE_HEADER: 1 or it is
+# picked by PROFILE_SAMPLE_RATE, and only for paths in PROFILE_PATHS (empty =
+# all). Only the newest PROFILE_MAX_FILES profiles are kept in PROFILE_DIR.
+PROFILING_ENABLED = bool(secrets.get('PROFILING_ENABLED', False))
+PROFILE_DIR = secrets.get('PROFILE_DIR', 'profiles')
+PROFILE_SAMPLE_RATE = float(secrets.get('PROFILE_SAMPLE_RATE', 0.0))
+PROFILE_PATHS = secrets.get('PROFILE_PATHS', [])
+PROFILE_MAX_FILES = int(secrets.get('PROFILE_MAX_FILES', 50))
+PROFILE_HEADER = 'X-Profile-Request'
+# Admission control (optional keys in secrets.json). Polling endpoints get a
+# per-session token bucket, and at most MAX_CONCURRENT_READS of them are handled
+# at once, so the rest of the server (guesses, login, the game page and other
+# form routes) is never turned away.
+RATE_LIMIT_ENABLED = bool(secrets.get('RATE_LIMIT_ENABLED', True))
+READ_RATE_PER_SECOND = float(secrets.get('READ_RATE_PER_SECOND', 2.0))
+READ_BURST = int(secrets.get('READ_BURST', 10))
+MAX_CONCURRENT_READS = int(secrets.get('MAX_CONCURRENT_READS', 16))
+RATE_LIMITED_PATHS = ['/current-song', '/leaderboard', '/leaderboard-history', '/stats', '/playlist-data']
+# Bounds on admission bookkeeping: replayed responses kept, and how long (seconds)
+# a refilled bucket may sit idle before it is dropped
+MAX_REPLAY_RESPONSES = 1024
+IDLE_BUCKET_SECONDS = 300
+# Only one profiler can be active in the interpreter at a time
+profile_lock = Lock()
+
+def bump_roster_version():
+    global ROSTER_VERSION
+    with roster_lock:
+        ROSTER_VERSION += 1
+
+# Function to build the sorted list of selectable players from multiple sources:
+# submitted song_queue, recorded added_songs_db entries, and known logged-in
+# users. Rebuilt only when ROSTER_VERSION has moved on.
+
+def get_roster():
+    with roster_lock:
+        if roster_cache['version'] == ROSTER_VERSION:
+            return roster_cache['users']
+        version = ROSTER_VERSION
+    all_users = set()
+    # From persistent song submissions
+    try:
+        song_queue = load_song_queue()
+        all_users.update(song_queue.keys())
+    except Exception:
+        pass
+    # From recorded add attempts
+    for users in list(added_songs_db.values()):
+        try:
+            all_users.update(users)
+        except Exception:
+            pass
+    # From known user display names
+    try:
+        all_users.update(USER_DISPLAY_NAMES.values())
+    except Exception:
+        pass
+    all_users = sorted([u for u in all_users if u])
+    with roster_lock:
+        roster_cache['version'] = version
+        roster_cache['users'] = all_users
+    return all_users
 
 def load_song_queue():
     if not os.path.exists(SONG_QUEUE_FILE):
@@ -85,6 +185,7 @@ def save_song_queue(data):
     with song_queue_lock:
         with open(SONG_QUEUE_FILE, 'w', encoding='utf-8') as f:
             json.dump(data, f)
+    bump_roster_version()
 
 def load_leaderboard():
     if not os.path.exists(LEADERBOARD_FILE):
@@ -101,6 +202,166 @@ def save_leaderboard(data):
         with open(LEADERBOARD_FILE, 'w', encoding='utf-8') as f:
             json.dump(data, f)
 
+def load_leaderboard_history():
+    if not os.path.exists(LEADERBOARD_HISTORY_FILE):
+        return []
+    with leaderboard_history_lock:
+        with open(LEADERBOARD_HISTORY_FILE, 'r', encoding='utf-8') as f:
+            try:
+                data = json.load(f)
+                # Ensure we always return a list of rounds
+                if not isinstance(data, list):
+                    return []
+                return data
+            except Exception:
+                return []
+
+def save_leaderboard_history(data):
+    with leaderboard_history_lock:
+        with open(LEADERBOARD_HISTORY_FILE, 'w', encoding='utf-8') as f:
+            json.dump(data, f)
+
+def load_top_tracks_cache():
+    if not os.path.exists(TOP_TRACKS_CACHE_FILE):
+        return {}
+    with open(TOP_TRACKS_CACHE_FILE, 'r', encoding='utf-8') as f:
+        try:
+            data = json.load(f)
+            if not isinstance(data, dict):
+                return {}
+            return data
+        except Exception:
+            return {}
+
+# Per-user top tracks cache: {"user_id:time_range:limit": {'fetched_at': ts, 'tracks': [...]}}
+# Kept across server restarts (unlike the .cache-* token files) so returning
+# players don't wait for Spotify every night.
+top_tracks_cache = load_top_tracks_cache()
+top_tracks_cache_lock = Lock()
+# Cache keys currently being refreshed in the background
+top_tracks_revalidating = set()
+
+def store_top_tracks(key, tracks):
+    with top_tracks_cache_lock:
+        top_tracks_cache[key] = {'fetched_at': time.time(), 'tracks': tracks}
+        with open(TOP_TRACKS_CACHE_FILE, 'w', encoding='utf-8') as f:
+            json.dump(top_tracks_cache, f)
+
+# Ranked leaderboard: scores plus an ordered index of (-score, name) pairs.
+# The index is kept sorted with bisect: finding a player's slot is O(log n), and
+# the list splice that moves them is an O(n) memmove, which is negligible for
+# the few hundred players of a tournament and avoids a full re-sort per request.
+# Rank / top-K queries read straight off the ordered list.
+class RankedLeaderboard:
+    def __init__(self, scores=None):
+        self._lock = Lock()
+        self._scores = {}
+        self._order = []
+        for name, score in (scores or {}).items():
+            self._scores[name] = score
+            self._order.append((-score, name))
+        self._order.sort()
+
+    def _set(self, name, score):
+        if name in self._scores:
+            idx = bisect.bisect_left(self._order, (-self._scores[name], name))
+            del self._order[idx]
+        self._scores[name] = score
+        bisect.insort(self._order, (-score, name))
+
+    def ensure_player(self, name):
+        with self._lock:
+            if name in self._scores:
+                return False
+            self._set(name, 0)
+            return True
+
+    def add_points(self, name, points):
+        with self._lock:
+            self._set(name, self._scores.get(name, 0) + points)
+
+    def standing(self, name):
+        # (score, rank, number of players) read together, or None if unknown.
+        # Competition ranking: tied players share a rank (1, 2, 2, 4, ...)
+        with self._lock:
+            if name not in self._scores:
+                return None
+            score = self._scores[name]
+            return score, bisect.bisect_left(self._order, (-score,)) + 1, len(self._scores)
+
+    def top(self, k=None):
+        with self._lock:
+            entries = self._order if k is None else self._order[:max(k, 0)]
+            return [[name, -neg_score] for neg_score, name in entries]
+
+    def end_round(self):
+        # Compact snapshot of the finished round (ranked [name, score] pairs,
+        # zeros omitted) taken and zeroed under one lock, keeping the roster, so
+        # no point can fall between rounds
+        with self._lock:
+            snapshot = [[name, -neg_score] for neg_score, name in self._order if neg_score]
+            self._scores = {name: 0 for name in self._scores}
+            self._order = sorted((0, name) for name in self._scores)
+            return snapshot
+
+    def to_dict(self):
+        with self._lock:
+            return dict(self._scores)
+
+# In-memory ranked leaderboard (mirrored to LEADERBOARD_FILE by leaderboard_writer)
+ranked_leaderboard = RankedLeaderboard(load_leaderboard())
+# In-memory round history (mirrored to LEADERBOARD_HISTORY_FILE)
+leaderboard_history = load_leaderboard_history()
+# Set when scores changed and LEADERBOARD_FILE needs rewriting
+leaderboard_dirty = Event()
+
+# Background writer: coalesces score changes into at most one leaderboard.json
+# write per LEADERBOARD_SAVE_INTERVAL instead of rewriting the file per point
+def leaderboard_writer():
+    while True:
+        leaderboard_dirty.wait()
+        time.sleep(LEADERBOARD_SAVE_INTERVAL)
+        leaderboard_dirty.clear()
+        try:
+            save_leaderboard(ranked_leaderboard.to_dict())
+        except Exception as e:
+            print('Warning: could not save leaderboard:', e)
+
+Thread(target=leaderboard_writer, daemon=True).start()
+
+def award_leaderboard_points(display_name, points):
+    ranked_leaderboard.add_points(display_name, points)
+    leaderboard_dirty.set()
+
+def end_leaderboard_round():
+    # Record the finished round's standings and start the next one from zero
+    with leaderboard_round_lock:
+        leaderboard_history.append({
+            'round': len(leaderboard_history) + 1,
+            'ended_at': str(datetime.now()),
+            'scores': ranked_leaderboard.end_round()
+        })
+        save_leaderboard_history(leaderboard_history)
+        round_number = len(leaderboard_history)
+    leaderboard_dirty.set()
+    return round_number
+
+# Function to fold one graded guess into the running statistics (O(1) per guess)
+def record_guess_stats(guesser, track_url, actual_users, correct):
+    hit = 1 if correct else 0
+    with guess_stats_lock:
+        track = track_guess_stats.setdefault(track_url, {'correct': 0, 'total': 0})
+        track['correct'] += hit
+        track['total'] += 1
+        player = player_guess_stats.setdefault(guesser, {'correct': 0, 'total': 0})
+        player['correct'] += hit
+        player['total'] += 1
+        row = guess_confusion.setdefault(guesser, {})
+        for adder in actual_users:
+            cell = row.setdefault(adder, {'correct': 0, 'total': 0})
+            cell['correct'] += hit
+            cell['total'] += 1
+
 # Helper function: Get a Spotipy client for the current user session
 # Handles token refresh if needed
 # Returns a Spotipy client authenticated for the current user
@@ -164,6 +425,50 @@ def get_spotify_client_for_user(user_id):
             return None
     return spotipy.Spotify(auth=token_info['access_token'])
 
+# Function to fetch a user's top tracks from Spotify with the metadata we display
+def fetch_top_tracks(sp, time_range):
+    items = sp.current_user_top_tracks(limit=TOP_TRACKS_LIMIT, time_range=time_range).get('items', [])
+    return [{
+        'id': track['id'],
+        'url': track['external_urls']['spotify'],
+        'name': track['name'],
+        'artist': ', '.join(artist['name'] for artist in track['artists']),
+        'album_image': track['album']['images'][0]['url'] if track.get('album') and track['album'].get('images') else None
+    } for track in items]
+
+def revalidate_top_tracks(sp, key, time_range):
+    try:
+        tracks = fetch_top_tracks(sp, time_range)
+        if tracks:
+            store_top_tracks(key, tracks)
+    except Exception as e:
+        print('Warning: could not refresh cached top tracks for', key, e)
+    finally:
+        with top_tracks_cache_lock:
+            top_tracks_revalidating.discard(key)
+
+# Function to get a user's top tracks, served from the disk cache when possible
+# Stale entries are returned immediately and refreshed on a background thread.
+# Raises if Spotify has to be asked and the call fails.
+
+def get_cached_top_tracks(sp, user_id, time_range='long_term'):
+    # Include the limit so changing TOP_TRACKS_LIMIT never serves lists of the old length
+    key = f'{user_id}:{time_range}:{TOP_TRACKS_LIMIT}'
+    with top_tracks_cache_lock:
+        entry = top_tracks_cache.get(key)
+        refresh = (entry is not None and key not in top_tracks_revalidating
+                   and time.time() - entry['fetched_at'] > TOP_TRACKS_CACHE_TTL)
+        if refresh:
+            top_tracks_revalidating.add(key)
+    if entry is None:
+        tracks = fetch_top_tracks(sp, time_range)
+        if tracks:
+            store_top_tracks(key, tracks)
+        return tracks
+    if refresh:
+        Thread(target=revalidate_top_tracks, args=(sp, key, time_range), daemon=True).start()
+    return entry['tracks']
+
 # Decorator to require Spotify login for protected routes
 # Redirects to /login if user is not authenticated
 
@@ -175,6 +480,222 @@ def login_required(f):
     decorated_function.__name__ = f.__name__
     return decorated_function
 
+# --- Admission control and per-session rate limiting ---
+# Token bucket: refills at `rate` tokens per second up to `capacity`
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def is_idle(self, now, idle_seconds):
+        # Full again (no client debt left) and untouched for idle_seconds
+        refilled = self.tokens + (now - self.updated) * self.rate >= self.capacity
+        return refilled and now - self.updated > idle_seconds
+
+    def take(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+# {client_id: TokenBucket} for read endpoints
+read_buckets = {}
+last_bucket_sweep = time.monotonic()
+# {(client_id, endpoint): (full_path, body, mimetype)} latest good read response
+# per client and endpoint (least recently used first), served instead of a 429
+# when that client is over its limit and asks for the same URL again
+last_read_responses = OrderedDict()
+admission_lock = Lock()
+in_flight_requests = 0
+
+def replay_key():
+    return (admission_client_id(), request.endpoint or request.path)
+
+# Drop buckets that have refilled and sat idle; called with admission_lock held
+def sweep_idle_buckets():
+    global last_bucket_sweep
+    now = time.monotonic()
+    if now - last_bucket_sweep < IDLE_BUCKET_SECONDS:
+        return
+    last_bucket_sweep = now
+    for client_id in [c for c, bucket in read_buckets.items() if bucket.is_idle(now, IDLE_BUCKET_SECONDS)]:
+        del read_buckets[client_id]
+
+def is_rate_limited_path(path):
+    return path in RATE_LIMITED_PATHS or path.startswith('/leaderboard/')
+
+def admission_client_id():
+    return session.get('user_id') or request.remote_addr
+
+# Forget a client's replayable response for an endpoint (e.g. after it changed)
+def forget_read_response(endpoint):
+    with admission_lock:
+        last_read_responses.pop((admission_client_id(), endpoint), None)
+
+def throttled_response():
+    cached = last_read_responses.get(replay_key())
+    if cached and cached[0] == request.full_path:
+        response = app.response_class(cached[1], mimetype=cached[2])
+    else:
+        response = jsonify({'error': 'Too many requests. Please slow down.'})
+        response.status_code = 429
+    response.headers['Retry-After'] = '1'
+    return response
+
+@app.before_request
+def admit_request():
+    global in_flight_requests
+    if not RATE_LIMIT_ENABLED or not is_rate_limited_path(request.path):
+        return
+    with admission_lock:
+        sweep_idle_buckets()
+        client_id = admission_client_id()
+        bucket = read_buckets.get(client_id)
+        if bucket is None:
+            bucket = read_buckets[client_id] = TokenBucket(READ_RATE_PER_SECOND, READ_BURST)
+        if not bucket.take():
+            return throttled_response()
+        if in_flight_requests >= MAX_CONCURRENT_READS:
+            return throttled_response()
+        in_flight_requests += 1
+    g.admitted = True
+
+@app.after_request
+def remember_read_response(response):
+    if g.get('admitted') and response.status_code == 200 and is_rate_limited_path(request.path):
+        # Never replay error bodies (some routes return them with status 200)
+        try:
+            body = json.loads(response.get_data())
+        except Exception:
+            return response
+        if isinstance(body, dict) and 'error' in body:
+            return response
+        key = replay_key()
+        with admission_lock:
+            last_read_responses[key] = (request.full_path, response.get_data(), response.mimetype)
+            last_read_responses.move_to_end(key)
+            while len(last_read_responses) > MAX_REPLAY_RESPONSES:
+                last_read_responses.popitem(last=False)
+    return response
+
+@app.teardown_request
+def release_admission(exc):
+    global in_flight_requests
+    if g.pop('admitted', False):
+        with admission_lock:
+            in_flight_requests -= 1
+
+# --- Opt-in request profiling ---
+# Selected requests run under cProfile; the raw pstats file (loadable in
+# snakeviz/flameprof for a flamegraph) and a text summary splitting time
+# between our code, Spotify network calls and the framework are written to
+# PROFILE_DIR.
+
+def should_profile_request():
+    if not PROFILING_ENABLED or request.path.startswith('/static'):
+        return False
+    if PROFILE_PATHS and request.path not in PROFILE_PATHS:
+        return False
+    if request.headers.get(PROFILE_HEADER) == '1':
+        # Only logged-in players of this server session may ask for a profile
+        return 'token_info' in session and session.get('session_version') == SERVER_SESSION_VERSION
+    return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+def profile_category(filename):
+    if filename == __file__ or os.path.basename(filename) == 'server.py':
+        return 'app'
+    if any(part in filename for part in ('spotipy', 'requests', 'urllib3', 'http/client', 'socket', 'ssl')):
+        return 'spotify/network'
+    if any(part in filename for part in ('flask', 'werkzeug', 'jinja2')):
+        return 'framework'
+    return 'other'
+
+# Builtins (filename '~') such as socket recv, SSL reads or time.sleep carry no
+# file of their own, so their self time is split across their callers' buckets
+# in proportion to the time spent on each call edge.
+def profile_shares(stats, func, memo, visiting=frozenset()):
+    if func in memo:
+        return memo[func]
+    filename = func[0]
+    callers = stats.stats[func][4]
+    if filename != '~' or not callers or func in visiting:
+        shares = {profile_category(filename): 1.0}
+    else:
+        shares = {}
+        weights = {caller: edge[3] for caller, edge in callers.items()}
+        total = sum(weights.values())
+        for caller, weight in weights.items():
+            fraction = weight / total if total else 1.0 / len(weights)
+            for category, share in profile_shares(stats, caller, memo, visiting | {func}).items():
+                shares[category] = shares.get(category, 0.0) + share * fraction
+    memo[func] = shares
+    return shares
+
+# Delete the oldest profiles (and their summaries) beyond PROFILE_MAX_FILES;
+# file names start with a timestamp, so name order is age order
+def rotate_request_profiles():
+    profiles = sorted(glob.glob(os.path.join(PROFILE_DIR, '*.prof')))
+    for path in profiles[:max(len(profiles) - PROFILE_MAX_FILES, 0)]:
+        for fname in (path, path[:-len('.prof')] + '.txt'):
+            try:
+                os.remove(fname)
+            except OSError:
+                pass
+
+def write_request_profile(profiler, elapsed):
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    stamp = datetime.now().strftime('%Y%m%d-%H%M%S-%f')
+    slug = re.sub(r'[^A-Za-z0-9]+', '_', request.path).strip('_') or 'root'
+    base = os.path.join(PROFILE_DIR, f'{stamp}-{request.method}-{slug}')
+    profiler.dump_stats(base + '.prof')
+    stream = io.StringIO()
+    stats = pstats.Stats(profiler, stream=stream)
+    # Attribute self time per category
+    totals = {}
+    memo = {}
+    for func, (_, _, tottime, _, _) in stats.stats.items():
+        for category, share in profile_shares(stats, func, memo).items():
+            totals[category] = totals.get(category, 0.0) + tottime * share
+    stream.write(f'{request.method} {request.path} took {elapsed * 1000:.1f} ms\n')
+    for category, seconds in sorted(totals.items(), key=lambda x: x[1], reverse=True):
+        stream.write(f'  {category:<16} {seconds * 1000:9.1f} ms\n')
+    stream.write('\n')
+    stats.sort_stats('cumulative').print_stats(30)
+    with open(base + '.txt', 'w', encoding='utf-8') as f:
+        f.write(stream.getvalue())
+    print('INFO: wrote request profile', base + '.prof')
+    rotate_request_profiles()
+
+@app.before_request
+def start_request_profile():
+    if not should_profile_request():
+        return
+    # Skip rather than wait if another request is already being profiled
+    if not profile_lock.acquire(blocking=False):
+        return
+    g.profiler = cProfile.Profile()
+    g.profile_started = time.perf_counter()
+    g.profiler.enable()
+
+@app.teardown_request
+def stop_request_profile(exc):
+    profiler = g.pop('profiler', None)
+    if profiler is None:
+        return
+    try:
+        profiler.disable()
+        write_request_profile(profiler, time.perf_counter() - g.pop('profile_started'))
+    except Exception as e:
+        print('Warning: could not write request profile:', e)
+    finally:
+        profile_lock.release()
+
 # --- Force redirect to login if not logged in, for all protected routes ---
 @app.before_request
 def require_login_for_protected_routes():
@@ -225,23 +746,27 @@ def get_or_create_spotify_game_playlist(sp):
 # Returns True if the song is present, False otherwise
 
 def is_song_in_playlist(track_url, sp):
-    playlist_id = spotify_game_playlist['id']
     # Extract track ID from the URL
     if 'track' in track_url:
         track_id = track_url.split('track/')[-1].split('?')[0]
     else:
         return False  # Invalid track URL
+    # Check if the extracted track ID is in the playlist
+    return track_id in get_playlist_track_ids(sp)
+
+# Function to retrieve the set of track IDs in the "SpotifyGame" playlist
+def get_playlist_track_ids(sp):
+    playlist_id = spotify_game_playlist['id']
     # Retrieve all tracks from the playlist (handle pagination)
     offset = 0
-    track_ids = []
+    track_ids = set()
     while True:
         response = sp.playlist_tracks(playlist_id, offset=offset)
-        track_ids.extend([track['track']['id'] for track in response['items'] if track['track']])
+        track_ids.update(track['track']['id'] for track in response['items'] if track['track'])
         if len(response['items']) < 100:
             break
         offset += 100
-    # Check if the extracted track ID is in the playlist
-    return track_id in track_ids
+    return track_ids
 
 # Function to clean a Spotify track URL (remove query parameters/fragments)
 def clean_url(track_url):
@@ -264,13 +789,100 @@ def add_song_to_playlist(track_url, user_id, sp):
                 added_songs_db[track_url].append(user_id)
         else:
             added_songs_db[track_url] = [user_id]
+        bump_roster_version()
         return False
     else:
         # Add the song to the playlist and track the user
         sp.playlist_add_items(spotify_game_playlist['id'], [track_url])
         added_songs_db[track_url] = [user_id]
+        bump_roster_version()
         return True
 
+# Function to lazily schedule all players' tracks into a spread-out play order
+# Each player's tracks are shuffled and placed at evenly spaced positions in
+# [0, 1) (random start offset plus a little jitter), then the per-player streams
+# are merged by position. The same seed always yields the same order, and
+# (track_url, player) pairs are produced one at a time in O(n log players).
+
+def schedule_tracks(tracks_by_player, seed=None):
+    rng = random.Random(seed)
+    streams = []
+    # Sort players so the order only depends on the seed, not on dict order
+    for index, player in enumerate(sorted(tracks_by_player)):
+        tracks = list(tracks_by_player[player])
+        if not tracks:
+            continue
+        rng.shuffle(tracks)
+        spacing = 1.0 / len(tracks)
+        offset = rng.random() * spacing
+        streams.append([
+            (offset + i * spacing + rng.uniform(-0.1, 0.1) * spacing, index, track_url, player)
+            for i, track_url in enumerate(tracks)
+        ])
+    for _, _, track_url, player in heapq.merge(*streams):
+        yield track_url, player
+
+# Function to add scheduled (track_url, user) pairs to the playlist in chunks
+# The playlist is read once up front and each chunk is written with a single
+# API call as soon as it has been scheduled. Returns the number of tracks added.
+
+def add_tracks_to_playlist_in_chunks(schedule, sp, chunk_size=100):
+    if not spotify_game_playlist:
+        get_or_create_spotify_game_playlist(sp)
+    existing_ids = get_playlist_track_ids(sp)
+    added_count = 0
+    schedule = iter(schedule)
+    try:
+        while True:
+            chunk = list(islice(schedule, chunk_size))
+            if not chunk:
+                break
+            # {track_url: (track_id, [users])} for tracks new to the playlist
+            to_add = {}
+            for track_url, user_id in chunk:
+                track_url = clean_url(track_url)
+                track_id = track_url.split('track/')[-1] if 'track' in track_url else None
+                if track_id and track_id in existing_ids:
+                    # Song already in playlist, update who tried to add it
+                    if user_id not in added_songs_db.setdefault(track_url, []):
+                        added_songs_db[track_url].append(user_id)
+                    continue
+                users = to_add.setdefault(track_url, (track_id, []))[1]
+                if user_id not in users:
+                    users.append(user_id)
+            if not to_add:
+                continue
+            # Record attribution only once the chunk is actually in the playlist
+            sp.playlist_add_items(spotify_game_playlist['id'], list(to_add))
+            for track_url, (track_id, users) in to_add.items():
+                added_songs_db[track_url] = users
+                if track_id:
+                    existing_ids.add(track_id)
+            added_count += len(to_add)
+    finally:
+        bump_roster_version()
+    return added_count
+
+# Function to render the room-wide parts of the game page (song details and
+# player dropdown). They are identical for every viewer while a track plays, so
+# they are rendered once per (track ID, roster version) and reused.
+
+def render_game_fragments(track):
+    key = (track.get('id') or track['external_urls']['spotify'], ROSTER_VERSION)
+    with game_fragment_lock:
+        if game_fragment_cache.get('key') == key:
+            return game_fragment_cache['song_html'], game_fragment_cache['roster_html']
+    song_html = render_template('_game_song.html', song={
+        'name': track['name'],
+        'artist': ', '.join(artist['name'] for artist in track['artists']),
+        'url': track['external_urls']['spotify'],
+        'album_image': track['album']['images'][0]['url'] if track.get('album') and track['album'].get('images') else None
+    })
+    roster_html = render_template('_game_roster.html', users=get_roster())
+    with game_fragment_lock:
+        game_fragment_cache.update(key=key, song_html=song_html, roster_html=roster_html)
+    return song_html, roster_html
+
 # Route: Start Spotify OAuth login flow
 # Generates a random state for CSRF protection
 @app.route('/login')
@@ -375,6 +987,7 @@ def callback():
         USER_DISPLAY_NAMES[user['id']] = session.get('display_name')
     except Exception:
         pass
+    bump_roster_version()
     # Mark this session as valid for the current server session version
     global SERVER_SESSION_VERSION
     session['session_version'] = SERVER_SESSION_VERSION
@@ -395,11 +1008,9 @@ def home():
     # Clear guessed tracks and leaderboard score for this user at the start
     session['guessed_tracks'] = []
     display_name = session.get('display_name', session.get('user_id', 'Unknown'))
-    leaderboard = load_leaderboard()
     # Ensure user has an entry in the leaderboard, but do not reset existing scores
-    if display_name not in leaderboard:
-        leaderboard[display_name] = 0
-        save_leaderboard(leaderboard)
+    if ranked_leaderboard.ensure_player(display_name):
+        leaderboard_dirty.set()
     return render_template('index.html', display_name=display_name)
 
 # Route: Add a song to the playlist (requires login)
@@ -421,7 +1032,7 @@ def add_song():
         flash(f"Song is already in the playlist. User {user_id} tried adding it again.", 'info')
     return redirect(url_for('home'))
 
-# Route: Add the current user's top 5 tracks to the playlist in random order
+# Route: Add the current user's top TOP_TRACKS_LIMIT tracks to the playlist in random order
 @app.route('/add-top-tracks', methods=['POST'])
 @login_required
 def add_top_tracks():
@@ -430,16 +1041,17 @@ def add_top_tracks():
         flash("Spotify authentication error. Please log in again.", 'danger')
         return redirect(url_for('login'))
     get_or_create_spotify_game_playlist(sp)
-    # Debug: print current session user and Spotify API user
+    # Debug: print current session user
     print('DEBUG: session user_id =', session.get('user_id'))
     print('DEBUG: session display_name =', session.get('display_name'))
+    user_id = session.get('user_id')
+    display_name = session.get('display_name', user_id)
     try:
-        api_user = sp.current_user()
-        print('DEBUG: Spotify API user =', api_user.get('id'), api_user.get('display_name'))
-        # Request the user's top 5 tracks over the long-term (all-time).
+        # Request the user's top TOP_TRACKS_LIMIT tracks over the long-term (all-time).
         # Spotify supports short_term, medium_term and long_term. There's no exact
         # 12-month window, so long_term is the closest to "whole year" / all-time.
-        top_tracks = sp.current_user_top_tracks(limit=5, time_range='long_term').get('items', [])
+        # Returning players are served from the persistent top tracks cache.
+        top_tracks = get_cached_top_tracks(sp, user_id, time_range='long_term')
     except Exception as e:
         flash("Could not fetch your top tracks from Spotify. Please enter 5 tracks manually.", 'warning')
         return redirect(url_for('manual_top_tracks'))
@@ -447,25 +1059,23 @@ def add_top_tracks():
         flash("No top tracks found for your account. Please enter 5 tracks manually.", 'warning')
         return redirect(url_for('manual_top_tracks'))
     # Save tracks both to memory and persistent storage
-    user_id = session.get('user_id')
-    display_name = session.get('display_name', user_id)
     
     # Save to memory
     global all_top_tracks
-    all_top_tracks[user_id] = [track['external_urls']['spotify'] for track in top_tracks]
+    all_top_tracks[user_id] = [track['url'] for track in top_tracks]
     
     # Save to file
     song_queue = load_song_queue()
     song_queue[display_name] = {
-        'tracks': [track['external_urls']['spotify'] for track in top_tracks],
+        'tracks': [track['url'] for track in top_tracks],
         'added_at': str(datetime.now())
     }
     save_song_queue(song_queue)
     
-    flash(f"Your top 5 (long-term) tracks have been saved. {len(song_queue)} players have submitted tracks!", 'success')
+    flash(f"Your top {TOP_TRACKS_LIMIT} (long-term) tracks have been saved. {len(song_queue)} players have submitted tracks!", 'success')
     return redirect(url_for('home'))
 
-# Route: Shuffle and add all players' top tracks to the playlist in interleaved order
+# Route: Shuffle and add all players' top tracks to the playlist in spread-out order
 @app.route('/shuffle-add-all', methods=['POST'])
 @login_required
 def shuffle_add_all():
@@ -496,21 +1106,17 @@ def shuffle_add_all():
         if display_name not in combined_tracks:  # Don't overwrite memory tracks
             combined_tracks[display_name] = data['tracks']
     
-    # Interleave tracks from all players
-    interleaved = []
-    if combined_tracks:
-        max_len = max(len(tracks) for tracks in combined_tracks.values())
-        for i in range(max_len):
-            for user, tracks in combined_tracks.items():
-                if i < len(tracks):
-                    interleaved.append((tracks[i], user))
-    # Shuffle the interleaved list for extra randomness
-    random.shuffle(interleaved)
-    added_count = 0
-    for track_url, user_id in interleaved:
-        if add_song_to_playlist(track_url, user_id, sp):
-            added_count += 1
-    flash(f"Added {added_count} tracks from {len(combined_tracks)} players to the playlist in shuffled order!", 'success')
+    # Spread each player's tracks apart; pass the same seed to reproduce an order
+    seed = request.form.get('seed', '').strip() or pysecrets.token_hex(4)
+    print('INFO: shuffling tracks with seed', seed)
+    try:
+        added_count = add_tracks_to_playlist_in_chunks(schedule_tracks(combined_tracks, seed), sp)
+    except Exception as e:
+        print('ERROR: adding shuffled tracks failed:', repr(e))
+        # Keep the submissions; a retry skips tracks that already made it in
+        flash(f"Spotify API error while adding tracks. Submissions were kept, please try again (seed {seed}).", 'danger')
+        return redirect(url_for('home'))
+    flash(f"Added {added_count} tracks from {len(combined_tracks)} players to the playlist in shuffled order! (seed {seed})", 'success')
     # Clear both memory and file storage after adding
     all_top_tracks = {}
     save_song_queue({})
@@ -597,7 +1203,7 @@ def game():
         return redirect(url_for('home'))
     if not playback or not playback.get('item'):
         flash('No song currently playing.', 'warning')
-        return render_template('game.html', song=None, users=[])
+        return render_template('game.html', song_html=None, roster_html='', remaining_guesses=0)
     track = playback['item']
     track_url = track['external_urls']['spotify']
     # Check if the currently playing song is in the game playlist
@@ -607,35 +1213,11 @@ def game():
     expected_uri = f'spotify:playlist:{playlist_id}'
     if context_uri and context_uri != expected_uri:
         flash('Warning: The currently playing song is not from the SpotifyGame playlist! Please play the correct playlist for the game to work.', 'danger')
-    # Find who added this song (if known)
-    # Build a list of selectable players from multiple sources: submitted
-    # song_queue, recorded added_songs_db entries, and known logged-in users.
-    all_users = set()
-    # From persistent song submissions
-    try:
-        song_queue = load_song_queue()
-        all_users.update(song_queue.keys())
-    except Exception:
-        pass
-    # From recorded add attempts
-    for users in added_songs_db.values():
-        try:
-            all_users.update(users)
-        except Exception:
-            pass
-    # From known user display names
-    try:
-        all_users.update(USER_DISPLAY_NAMES.values())
-    except Exception:
-        pass
-    all_users = sorted([u for u in all_users if u])
-    # If no users, show empty dropdown
-    return render_template('game.html', song={
-        'name': track['name'],
-        'artist': ', '.join(artist['name'] for artist in track['artists']),
-        'url': track_url,
-        'album_image': track['album']['images'][0]['url'] if track.get('album') and track['album'].get('images') else None
-    }, users=all_users)
+    # Song details and player dropdown are shared by the whole room; only the
+    # remaining guesses (and flashes) are filled in per viewer.
+    song_html, roster_html = render_game_fragments(track)
+    remaining = max(GUESS_LIMIT - session.get('guessed_counts', {}).get(track_url, 0), 0)
+    return render_template('game.html', song_html=song_html, roster_html=roster_html, remaining_guesses=remaining)
 
 # Route: Accept a guess for who added the current song (form POST)
 @app.route('/guess-song', methods=['POST'])
@@ -665,7 +1247,6 @@ def guess_song():
     guess_user = request.form.get('guess_user')
     actual_users = added_songs_db.get(track_url, [])
     display_name = session.get('display_name', session.get('user_id', 'Unknown'))
-    leaderboard = load_leaderboard()
 
     # Initialize per-session guess tracking structures if missing
     guessed_counts = session.get('guessed_counts', {})
@@ -676,9 +1257,12 @@ def guess_song():
         return redirect(url_for('game'))
 
     # Process guess: one attempt only. Award point on correct, otherwise no point.
-    if guess_user in actual_users:
-        leaderboard[display_name] = leaderboard.get(display_name, 0) + 1
-        save_leaderboard(leaderboard)
+    correct = guess_user in actual_users
+    # Only graded guesses count: unknown tracks have no adder to grade against
+    if actual_users:
+        record_guess_stats(display_name, track_url, actual_users, correct)
+    if correct:
+        award_leaderboard_points(display_name, 1)
         flash(f'Correct! {guess_user} added this song.', 'success')
     else:
         flash(f'Incorrect. This song was added by: {", ".join(actual_users) if actual_users else "Unknown"}', 'danger')
@@ -686,24 +1270,68 @@ def guess_song():
     # Mark that this session used their guess for this track
     guessed_counts[track_url] = guessed_counts.get(track_url, 0) + 1
     session['guessed_counts'] = guessed_counts
+    # A replayed /current-song would still show the guess as available
+    forget_read_response('current_song')
     return redirect(url_for('game'))
 
 @app.route('/leaderboard')
 def get_leaderboard():
-    leaderboard = load_leaderboard()
-    # Return sorted leaderboard
-    sorted_lb = sorted(leaderboard.items(), key=lambda x: x[1], reverse=True)
-    return jsonify(sorted_lb)
+    # Return ranked leaderboard, optionally only the first ?top=K entries
+    top = request.args.get('top', type=int)
+    return jsonify(ranked_leaderboard.top(top))
+
+# Route: Score and rank of a single player
+@app.route('/leaderboard/<path:player>')
+def get_player_rank(player):
+    standing = ranked_leaderboard.standing(player)
+    if standing is None:
+        return jsonify({'error': f'Unknown player: {player}'}), 404
+    score, rank, players = standing
+    return jsonify({
+        'player': player,
+        'score': score,
+        'rank': rank,
+        'players': players
+    })
+
+# Route: Snapshots of finished rounds, newest last (?limit=N for the last N)
+@app.route('/leaderboard-history')
+def get_leaderboard_history():
+    limit = request.args.get('limit', type=int)
+    if limit is None:
+        return jsonify(leaderboard_history)
+    return jsonify(leaderboard_history[-limit:] if limit > 0 else [])
 
 
 @app.route('/reset-leaderboard', methods=['POST'])
 @login_required
 def reset_leaderboard():
-    # Reset leaderboard to empty
-    save_leaderboard({})
-    flash('Leaderboard has been reset.', 'success')
+    # Close the current round (snapshot kept in history) and zero all scores
+    round_number = end_leaderboard_round()
+    flash(f'Leaderboard has been reset. Round {round_number} saved to history.', 'success')
     return redirect(url_for('home'))
 
+# Route: Guess statistics (per-track difficulty, per-player accuracy, who fools whom)
+@app.route('/stats')
+def get_stats():
+    with guess_stats_lock:
+        tracks = [
+            {'url': url, 'correct': t['correct'], 'total': t['total'],
+             'difficulty': round(1 - t['correct'] / t['total'], 3)}
+            for url, t in track_guess_stats.items()
+        ]
+        players = [
+            {'player': name, 'correct': p['correct'], 'total': p['total'],
+             'accuracy': round(p['correct'] / p['total'], 3)}
+            for name, p in player_guess_stats.items()
+        ]
+        confusion = {guesser: {adder: dict(cell) for adder, cell in row.items()}
+                     for guesser, row in guess_confusion.items()}
+    # Hardest tracks and most accurate players first
+    tracks.sort(key=lambda x: (x['difficulty'], x['total']), reverse=True)
+    players.sort(key=lambda x: (x['accuracy'], x['total']), reverse=True)
+    return jsonify({'tracks': tracks, 'players': players, 'confusion': confusion})
+
 # Route: Current song info (for real-time updates)
 @app.route('/current-song')
 @login_required
@@ -738,22 +1366,7 @@ def current_song():
     if remaining < 0:
         remaining = 0
     # Build a list of all players so the frontend shows all selectable options
-    players = set()
-    try:
-        sq = load_song_queue()
-        players.update(sq.keys())
-    except Exception:
-        pass
-    for users in added_songs_db.values():
-        try:
-            players.update(users)
-        except Exception:
-            pass
-    try:
-        players.update(USER_DISPLAY_NAMES.values())
-    except Exception:
-        pass
-    players = sorted([p for p in players if p])
+    players = get_roster()
     # Try to get album image if available
     album_image = None
     if track.get('album') and track['album'].get('images'):
@@ -785,6 +1398,13 @@ if __name__ == '__main__':
         print('INFO: leaderboard reset at startup')
     except Exception as e:
         print('Warning: Could not reset leaderboard file:', e)
+    # Start the evening with an empty round history as well
+    try:
+        save_leaderboard_history([])
+    except Exception as e:
+        print('Warning: Could not reset leaderboard history file:', e)
+    ranked_leaderboard = RankedLeaderboard()
+    leaderboard_history = []
     all_top_tracks = {}
     added_songs_db = {}
     spotify_game_playlist = None